@@ -1,143 +1,280 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, re, sys, datetime
-from dateutil.relativedelta import relativedelta
+import os, io, sys, json, shutil, tempfile, datetime, functools
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 LOGIN = os.environ.get("GH_LOGIN", "").strip()
 TOKEN = os.environ.get("GITHUB_TOKEN", "").strip()
+# own repos listed under "Total Stars": one full GraphQL page (the API maximum)
+TOP_REPOS = 100
+DEBUG = bool(os.environ.get("GH_STATS_DEBUG"))
+THIS_YEAR = datetime.datetime.now(datetime.timezone.utc).year
 
 API = "https://api.github.com/graphql"
+REST_API = "https://api.github.com"
 HEADERS = {"Authorization": f"bearer {TOKEN}"}
 
-def gql(query, variables=None):
-    r = requests.post(API, headers=HEADERS, json={"query": query, "variables": variables or {}})
+STATS_START = "<!--STATS:START-->"
+STATS_END = "<!--STATS:END-->"
+
+# one keep-alive session for every call: saves a TCP+TLS handshake per query
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+# GraphQL JSON is key-heavy and compresses well; requests decodes it transparently
+SESSION.headers["Accept-Encoding"] = "gzip"
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=8,
+    # GraphQL reads are idempotent, so POST is safe to retry; 429 honours Retry-After
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504],
+                      allowed_methods=["GET", "POST"]),
+))
+
+# ---------- on-disk cache ----------
+
+CACHE_DIR = ".cache"
+STARS_PATH = os.path.join(CACHE_DIR, "stars.json")
+
+# bump when the shape or meaning of .cache/stats-<login>-YYYY.json changes
+YEAR_CACHE_VERSION = 1
+
+def year_cache_path(year):
+    return os.path.join(CACHE_DIR, f"stats-{LOGIN.lower()}-{year}.json")
+
+def year_is_frozen(year):
+    """GitHub keeps attributing late contributions (back-dated commits, repos made
+    public later) to the year that just ended, so only cache the ones before it."""
+    return year < THIS_YEAR - 1
+
+def read_json(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def write_json(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f)
+
+def gql(query, variables=None, partial=False):
+    """POST a GraphQL query and return its data. With partial=True, NOT_FOUND errors
+    (fields that resolved to null) are tolerated as long as data came back."""
+    body = orjson.dumps({"query": query, "variables": variables or {}})
+    r = SESSION.post(API, data=body, headers={"Content-Type": "application/json"}, timeout=30)
     r.raise_for_status()
-    data = r.json()
-    if "errors" in data:
+    if DEBUG and r.headers.get("Content-Encoding") != "gzip":
+        print(f"gql: uncompressed response ({len(r.content)} bytes)", file=sys.stderr)
+    data = orjson.loads(r.content)
+    if "errors" in data and not (
+        partial and data.get("data") and all(e.get("type") == "NOT_FOUND" for e in data["errors"])
+    ):
         raise RuntimeError(data["errors"])
     return data["data"]
 
 # ---------- data fetch ----------
 
-def get_own_public_repos_and_total_stars():
-    """own public (non-fork) repos + total stars, sorted by stars -> forks"""
-    repos, total = [], 0
-    cursor = None
-    while True:
-        q = """
-        query($login:String!, $cursor:String) {
-          user(login:$login){
-            repositories(ownerAffiliations: OWNER, isFork:false, privacy:PUBLIC, first:100, after:$cursor){
-              pageInfo { hasNextPage endCursor }
-              nodes { nameWithOwner url stargazerCount forkCount }
-            }
-          }
-        }"""
-        d = gql(q, {"login": LOGIN, "cursor": cursor})
-        page = d["user"]["repositories"]
-        for n in page["nodes"]:
-            total += n["stargazerCount"]
-            repos.append({
-                "name": n["nameWithOwner"],
-                "url": n["url"],
-                "stars": n["stargazerCount"],
-                "forks": n["forkCount"],
-            })
-        if page["pageInfo"]["hasNextPage"]:
-            cursor = page["pageInfo"]["endCursor"]
+# top-K rows that get rendered (every displayed field) + contribution years
+_Q_REPOS = """
+query($login:String!, $top:Int!) {
+  user(login:$login){
+    contributionsCollection { contributionYears }
+    repositories(ownerAffiliations: OWNER, isFork:false, privacy:PUBLIC, first:$top,
+                 orderBy:{field:STARGAZERS, direction:DESC}){
+      pageInfo { hasNextPage endCursor }
+      nodes { nameWithOwner url stargazerCount forkCount }
+    }
+  }
+}"""
+
+# shared selection for every per-year alias built by contrib_query()
+_Q_CONTRIB = """
+fragment ContribFields on ContributionsCollection {
+  pullRequestContributionsByRepository(maxRepositories:100) {
+    repository { nameWithOwner }
+    contributions { totalCount }
+  }
+  issueContributionsByRepository(maxRepositories:100) {
+    repository { nameWithOwner }
+    contributions { totalCount }
+  }
+  commitContributionsByRepository(maxRepositories:100) {
+    repository { nameWithOwner }
+    contributions { totalCount }
+  }
+}"""
+
+def get_overview():
+    """top-K own public (non-fork) repos by stars, their first page's pageInfo and the
+    contribution years -- everything the later queries depend on, in one round-trip"""
+    d = gql(_Q_REPOS, {"login": LOGIN, "top": TOP_REPOS})
+    page = d["user"]["repositories"]
+    repos = [{
+        "name": n["nameWithOwner"],
+        "url": n["url"],
+        "stars": n["stargazerCount"],
+        "forks": n["forkCount"],
+    } for n in page["nodes"]]
+    # order is irrelevant for summing; dedupe without re-sorting
+    years = list(dict.fromkeys(d["user"]["contributionsCollection"]["contributionYears"]))
+    if THIS_YEAR not in years:
+        years.append(THIS_YEAR)
+    return repos, page["pageInfo"], years
+
+def get_total_stars(repos, page_info):
+    """stars over every own public non-fork repo.
+
+    When the top-K page already holds them all that is just its sum. Otherwise the REST
+    repo list is walked with If-None-Match per page: unchanged pages answer 304 (no body,
+    no rate-limit cost) and reuse the per-page star sum from .cache/stars.json.
+    """
+    if not page_info["hasNextPage"]:
+        return sum(r["stars"] for r in repos)
+    cache = read_json(STARS_PATH, {})
+    pages = {}
+    url = f"{REST_API}/users/{LOGIN}/repos?type=owner&per_page=100"
+    while url:
+        cached = cache.get(url)
+        headers = {"If-None-Match": cached["etag"]} if cached and cached["etag"] else None
+        r = SESSION.get(url, headers=headers, timeout=30)
+        if r.status_code == 304 and cached:
+            page = cached
         else:
-            break
-    repos.sort(key=lambda x: (-x["stars"], -x["forks"]))
-    return repos, total
-
-def get_years():
-    q = """
-    query($login:String!){
-      user(login:$login){
-        contributionsCollection { contributionYears }
-      }
-    }"""
-    d = gql(q, {"login": LOGIN})
-    years = sorted(set(d["user"]["contributionsCollection"]["contributionYears"]))
-    y = datetime.datetime.utcnow().year
-    if y not in years:
-        years.append(y)
-    return years
-
-def collect_by_year(year):
-    start = datetime.datetime(year, 1, 1)
-    end = datetime.datetime(year + 1, 1, 1) - relativedelta(seconds=1)
-    q = """
-    query($login:String!, $from:DateTime!, $to:DateTime!){
-      user(login:$login){
-        contributionsCollection(from:$from, to:$to){
-          pullRequestContributionsByRepository(maxRepositories:100) {
-            repository { nameWithOwner url stargazerCount forkCount }
-            contributions(first:1){ totalCount }
-          }
-          issueContributionsByRepository(maxRepositories:100) {
-            repository { nameWithOwner url stargazerCount forkCount }
-            contributions(first:1){ totalCount }
-          }
-          commitContributionsByRepository(maxRepositories:100) {
-            repository { nameWithOwner url stargazerCount forkCount }
-            contributions(first:1){ totalCount }
-          }
-        }
-      }
-    }"""
-    d = gql(q, {"login": LOGIN, "from": start.isoformat(), "to": end.isoformat()})
-    cc = d["user"]["contributionsCollection"]
-
+            r.raise_for_status()
+            page = {
+                "etag": r.headers.get("ETag", ""),
+                "stars": sum(n["stargazers_count"] for n in orjson.loads(r.content) if not n["fork"]),
+                "next": r.links.get("next", {}).get("url"),
+            }
+        pages[url] = page
+        url = page["next"]
+    write_json(STARS_PATH, pages)
+    return sum(p["stars"] for p in pages.values())
+
+def contrib_query(years):
+    """one document aliasing contributionsCollection per year: y2020, y2021, ..."""
+    aliases = "".join(
+        f'\n    y{y}: contributionsCollection(from:"{y}-01-01T00:00:00Z", to:"{y}-12-31T23:59:59Z")'
+        " { ...ContribFields }"
+        for y in years
+    )
+    return "query($login:String!){\n  user(login:$login){%s\n  }\n}\n%s" % (aliases, _Q_CONTRIB)
+
+def repo_meta_query(names):
+    """canonical name + stars/forks once per contributed repo:
+    r0: repository(owner:..., name:...), r1: ..."""
+    aliases = "".join(
+        f"\n  r{i}: repository(owner:{json.dumps(owner)}, name:{json.dumps(repo)})"
+        " { nameWithOwner stargazerCount forkCount }"
+        for i, (owner, _, repo) in enumerate(n.partition("/") for n in names)
+    )
+    return "query{%s\n}" % aliases
+
+def repo_url(name_with_owner):
+    return f"https://github.com/{name_with_owner}"
+
+@dataclass(slots=True)
+class RepoStat:
+    url: str
+    commit: int = 0
+    pr: int = 0
+    issue: int = 0
+    # filled in by a single metadata query after all years are merged
+    stars: int = 0
+    forks: int = 0
+
+def parse_year(cc):
+    """one year's contributionsCollection -> {nameWithOwner: RepoStat}"""
     repo_map = {}
-    def add(repo, key, n):
+    def stat(repo):
         k = repo["nameWithOwner"]
-        repo_map.setdefault(k, {
-            "url": repo["url"], "stars": repo["stargazerCount"], "forks": repo["forkCount"],
-            "commit": 0, "pr": 0, "issue": 0
-        })
-        repo_map[k][key] += n
-        repo_map[k]["stars"] = repo["stargazerCount"]
-        repo_map[k]["forks"] = repo["forkCount"]
-        repo_map[k]["url"] = repo["url"]
+        rec = repo_map.get(k)
+        if rec is None:
+            rec = repo_map[k] = RepoStat(repo_url(k))
+        return rec
 
     for r in cc["commitContributionsByRepository"]:
-        add(r["repository"], "commit", r["contributions"]["totalCount"])
+        stat(r["repository"]).commit += r["contributions"]["totalCount"]
     for r in cc["pullRequestContributionsByRepository"]:
-        add(r["repository"], "pr", r["contributions"]["totalCount"])
+        stat(r["repository"]).pr += r["contributions"]["totalCount"]
     for r in cc["issueContributionsByRepository"]:
-        add(r["repository"], "issue", r["contributions"]["totalCount"])
+        stat(r["repository"]).issue += r["contributions"]["totalCount"]
 
     return repo_map
 
-def aggregate_contributions_all_time():
-    years = get_years()
+def collect_years(years):
+    """{year: {nameWithOwner: RepoStat}}; frozen years come from .cache when present"""
+    parts, missing = {}, []
+    for y in years:
+        cached = read_json(year_cache_path(y), None) if year_is_frozen(y) else None
+        if not isinstance(cached, dict) or cached.get("version") != YEAR_CACHE_VERSION:
+            missing.append(y)
+        else:
+            parts[y] = {name: RepoStat(repo_url(name), *counts)
+                        for name, counts in cached["repos"].items()}
+    if missing:
+        d = gql(contrib_query(missing), {"login": LOGIN})
+        for y in missing:
+            parts[y] = parse_year(d["user"][f"y{y}"])
+            if year_is_frozen(y):
+                write_json(year_cache_path(y), {
+                    "version": YEAR_CACHE_VERSION,
+                    "repos": {name: [r.commit, r.pr, r.issue] for name, r in parts[y].items()},
+                })
+    return parts
+
+def aggregate_contributions_all_time(years):
+    login_lc = LOGIN.lower()
+    parts = collect_years(years)
     merged = {}
     for y in years:
-        part = collect_by_year(y)
-        for name, rec in part.items():
-            if name not in merged:
-                merged[name] = rec.copy()
+        for name, rec in parts[y].items():
+            m = merged.get(name)
+            if m is None:
+                merged[name] = rec  # part is discarded, take ownership
             else:
-                for k in ("commit", "pr", "issue"):
-                    merged[name][k] += rec[k]
-            merged[name]["stars"] = rec["stars"]
-            merged[name]["forks"] = rec["forks"]
-            merged[name]["url"] = rec["url"]
+                m.commit += rec.commit
+                m.pr += rec.pr
+                m.issue += rec.issue
+
+    active = {name: v for name, v in merged.items() if v.commit + v.pr + v.issue}
+    if active:
+        # deleted / now-private repos come back as null: drop them rather than fail.
+        # Names from cached years may be stale, so re-key under the canonical name,
+        # merging a renamed repo's old and new rows.
+        meta = gql(repo_meta_query(active), partial=True)
+        resolved = {}
+        for i, v in enumerate(active.values()):
+            m = meta.get(f"r{i}")
+            if not m:
+                continue
+            name = m["nameWithOwner"]
+            rec = resolved.get(name)
+            if rec is None:
+                v.url = repo_url(name)
+                v.stars, v.forks = m["stargazerCount"], m["forkCount"]
+                resolved[name] = v
+            else:
+                rec.commit += v.commit
+                rec.pr += v.pr
+                rec.issue += v.issue
+        active = resolved
 
     mine, others = [], []
-    for name, v in merged.items():
-        total = v["commit"] + v["pr"] + v["issue"]
-        if total == 0:
-            continue
+    for name, v in active.items():
+        total = v.commit + v.pr + v.issue
         row = {
-            "name": name, "url": v["url"], "stars": v["stars"], "forks": v["forks"],
-            "commit": v["commit"], "pr": v["pr"], "issue": v["issue"], "total": total
+            "name": name, "url": v.url, "stars": v.stars, "forks": v.forks,
+            "commit": v.commit, "pr": v.pr, "issue": v.issue, "total": total
         }
-        owner = name.split("/")[0].lower() if "/" in name else ""
-        (mine if owner == LOGIN.lower() else others).append(row)
+        owner, sep, _ = name.partition("/")
+        (mine if sep and owner.lower() == login_lc else others).append(row)
 
     keyf = lambda r: (-r["stars"], -r["forks"])
     mine.sort(key=keyf)
@@ -154,6 +291,7 @@ def to_k_plus(n: int) -> str:
         return f"{v}k+"
     return str(n)
 
+@functools.lru_cache(maxsize=1024)
 def pretty_repo_text(full_name: str) -> str:
     """
     'owner/repo-name_x' -> 'Repo Name X' (title-cased), but keep URL link text only.
@@ -171,82 +309,100 @@ def repo_chip(name, url, stars, forks):
     pretty = pretty_repo_text(name)
     return f'<a href="{url}">{pretty}</a> <sub>· ⭐ {star_text}{fire} · 🍴 {forks}</sub>'
 
-def md_table_contrib(rows):
+def write_table_contrib(buf, rows):
     if not rows:
-        return "_(empty)_"
-    header = (
+        buf.write("_(empty)_")
+        return
+    buf.write(
         "| Repository | 📝 Commits | 🔀 PRs | 🐛 Issues | ∑ Total |\n"
         "|:--|--:|--:|--:|--:|"
     )
-    lines = [
-        f'| {repo_chip(r["name"], r["url"], r["stars"], r["forks"])} | '
-        f'`{r["commit"]}` | `{r["pr"]}` | `{r["issue"]}` | **`{r["total"]}`** |'
-        for r in rows
-    ]
-    return "\n".join([header] + lines)
-
-def md_list_own_stars(rows):
+    for r in rows:
+        buf.write(
+            f'\n| {repo_chip(r["name"], r["url"], r["stars"], r["forks"])} | '
+            f'`{r["commit"]}` | `{r["pr"]}` | `{r["issue"]}` | **`{r["total"]}`** |'
+        )
+
+def write_list_own_stars(buf, rows):
     if not rows:
-        return "_(empty)_"
+        buf.write("_(empty)_")
+        return
     # bullet list looks classy for a longer set
-    items = [f'- {repo_chip(r["name"], r["url"], r["stars"], r["forks"])}' for r in rows]
-    return "\n".join(items)
+    buf.write("\n".join(f'- {repo_chip(r["name"], r["url"], r["stars"], r["forks"])}' for r in rows))
 
 # ---------- render blocks ----------
 
-def render_markdown(own_repos, total_stars, contrib):
-    stars_block = f"""
-<details>
-  <summary><b>⭐ Total Stars Earned:</b> <code>{to_k_plus(total_stars)}</code></summary>
-
-  <br/>
-{md_list_own_stars(own_repos)}
-</details>
-""".strip()
-
-    contrib_block = f"""
-<details>
-  <summary><b>🤝 Contributed to:</b> <code>{contrib["count_total"]}</code></summary>
-
-  <br/>
-  <div><b>👥 Other Repos</b></div>
-
-{md_table_contrib(contrib["others"])}
-
-  <br/><br/>
-  <div><b>📦 My Repos</b></div>
-
-{md_table_contrib(contrib["mine"])}
-
-</details>
-""".strip()
+def write_contrib_block(buf, contrib):
+    buf.write(
+        "<details>\n"
+        f'  <summary><b>🤝 Contributed to:</b> <code>{contrib["count_total"]}</code></summary>\n\n'
+        "  <br/>\n"
+        "  <div><b>👥 Other Repos</b></div>\n\n"
+    )
+    write_table_contrib(buf, contrib["others"])
+    buf.write(
+        "\n\n  <br/><br/>\n"
+        "  <div><b>📦 My Repos</b></div>\n\n"
+    )
+    write_table_contrib(buf, contrib["mine"])
+    buf.write("\n\n</details>\n\n")
 
-    return f"""
-<div align="left">
+def render_markdown(own_repos, total_stars, contrib):
+    buf = io.StringIO()
+    buf.write('<div align="left">\n\n')
 
-{stars_block}
+    buf.write(
+        "<details>\n"
+        f"  <summary><b>⭐ Total Stars Earned:</b> <code>{to_k_plus(total_stars)}</code></summary>\n\n"
+        "  <br/>\n"
+    )
+    write_list_own_stars(buf, own_repos)
+    buf.write("\n</details>\n\n")
 
-{contrib_block}
+    if contrib["count_total"]:
+        write_contrib_block(buf, contrib)
 
-</div>
-""".strip()
+    buf.write("</div>")
+    return buf.getvalue()
 
 # ---------- main ----------
 
+def splice_block(content, block):
+    """Replace whatever sits between the STATS markers -> (new content, markers found).
+    Content comes back unchanged if either marker is missing."""
+    i = content.find(STATS_START)
+    j = content.find(STATS_END, i) if i != -1 else -1
+    if i == -1 or j == -1:
+        return content, False
+    return content[:i] + STATS_START + "\n" + block + "\n" + content[j:], True
+
+def write_atomic(path, text):
+    """Write via a sibling temp file + os.replace so a cancelled run never leaves it half-written."""
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(path) or ".",
+                                     delete=False) as tmp:
+        tmp.write(text)
+    shutil.copymode(path, tmp.name)
+    os.replace(tmp.name, path)
+
 def main():
-    own_repos, total_stars = get_own_public_repos_and_total_stars()
-    contrib = aggregate_contributions_all_time()
+    own_repos, page_info, years = get_overview()
+    # the remaining star pages and the contributions batch are independent
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        stars_f = ex.submit(get_total_stars, own_repos, page_info)
+        contrib_f = ex.submit(aggregate_contributions_all_time, years)
+        total_stars = stars_f.result()
+        contrib = contrib_f.result()
     block = render_markdown(own_repos, total_stars, contrib)
 
     with open("README.md", "r", encoding="utf-8") as f:
         content = f.read()
 
-    pattern = re.compile(r"(<!--STATS:START-->)(.*?)(<!--STATS:END-->)", re.S)
-    new = re.sub(pattern, r"\1\n" + block + r"\n\3", content)
+    new, spliced = splice_block(content, block)
+    if not spliced:
+        print("STATS markers not found in README.md.", file=sys.stderr)
 
     if new != content:
-        with open("README.md", "w", encoding="utf-8") as f:
-            f.write(new)
+        write_atomic("README.md", new)
         print("README updated.")
     else:
         print("No changes.")